@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# compares the reactive charging policy with top ups when tasks arrive in
+# bursts, which is when idle robots have time to top up
+
+import argparse
+import random
+import sys
+
+from task_allocation import build_scenario, ResultsCollector, TaskTrolly
+
+
+# -> (tasks completed, mean ticks a task waited for a robot, robot ticks
+#     spent idle, robot ticks spent flat and waiting for a station)
+def run(seed, top_up, ticks, burst, every, store_size=99):
+    tm = build_scenario(seed, qty_tasks=0, store_size=store_size,
+                        top_up=top_up)
+    results = ResultsCollector()
+    tm.collect_results(results)
+    rnd = random.Random(seed)
+
+    while tm.tick_count < ticks:
+        # a new task every few ticks during a burst, then nothing for as long
+        if ((tm.tick_count // burst) % 2 == 0
+                and tm.tick_count % every == 0):
+            tm.add_task(TaskTrolly(*rnd.sample(range(store_size), 2)))
+        tm.tick()
+
+    # -1 marks tasks that were never assigned or never completed
+    waits = [w for w in results.tasks.column('wait_ticks') if w >= 0]
+    completed = sum(1 for t in results.tasks.column('completed_tick')
+                    if t >= 0)
+    idle = ticks * len(tm.robots) - sum(results.robots.column('busy_ticks'))
+    flat = sum(results.robots.column('charge_wait_ticks'))
+
+    return completed, sum(waits) / max(1, len(waits)), idle, flat
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare charging policies with bursty task arrivals")
+    parser.add_argument('--seeds', type=int, default=3)
+    parser.add_argument('--ticks', type=int, default=6000)
+    parser.add_argument('--burst', type=int, default=300,
+                        help="ticks of arrivals, then as many without")
+    parser.add_argument('--every', type=int, default=4,
+                        help="ticks between arrivals during a burst, 20 "
+                             "robots keep up with about one every 3")
+    args = parser.parse_args(argv)
+
+    print("seed  policy    completed  mean wait  idle ticks  flat ticks")
+    for seed in range(args.seeds):
+        for name, top_up in [('reactive', False), ('top up', True)]:
+            print("%4s  %-8s  %9s  %9.1f  %10s  %10s"
+                  % ((seed, name) + run(seed, top_up, args.ticks,
+                                        args.burst, args.every)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# runs seeded scenarios through the reference objects and through each fast
+# path, tick by tick, and checks they agree and that the fast paths are
+# still fast, see the readme for how to run more scenarios or record speeds
+
+import contextlib
+import json
+import os
+import random
+import time
+import unittest
+from unittest import mock
+
+import task_allocation
+from task_allocation import Robot, TaskManager, TaskTrolly, OrderedTaskSet
+from task_allocation import TaskBase
+from task_allocation import min_cost_task
+
+SCENARIOS = int(os.environ.get('DIFFERENTIAL_SCENARIOS', 1000))
+MAX_TICKS = 300
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'speedup_baseline.json')
+
+
+# the matcher before candidate rankings were reused
+def reference_match(robots_, tasks):
+    robots = robots_.copy()
+    results = []
+    while (len(robots) > 0 and len(tasks) > 0):
+        task_costs = map(lambda r: (r, min_cost_task(r, tasks)), robots)
+        robot, (task, _) = max(task_costs,
+                               key=lambda z: (z[1][1] is not None,
+                                              z[1][1] or ()))
+        if task is not None:
+            results.append((robot, task))
+            tasks.remove(task)
+        robots.remove(robot)
+    return results
+
+
+# seed -> scenario, small enough that a mismatch is easy to read
+def random_scenario(seed):
+    rnd = random.Random(seed)
+    store_size = rnd.choice([10, 30, 99])
+    return {
+        'stations': rnd.sample(range(store_size), rnd.randrange(0, 3)),
+        'robots': [(rnd.randrange(store_size),
+                    rnd.choice([0, rnd.uniform(0, 99)]))
+                   for _ in range(rnd.randrange(1, 6))],
+        'tasks': [rnd.sample(range(store_size), 2)
+                  for _ in range(rnd.randrange(0, 15))],
+        'fork_at': rnd.randrange(0, 20),
+    }
+
+
+# every task, including the charge tasks made each tick, costs each of its
+# subtasks in turn instead of using a compiled kernel
+def reference_costs():
+    return mock.patch.object(TaskBase, 'compile_costs', lambda self: False)
+
+
+# scenario -> TaskManager, tasks are kept in insertion order so every
+# engine sees them in the same order and breaks ties the same way
+def build(scenario):
+    tm = TaskManager({station: None for station in scenario['stations']})
+    tm.tasks = OrderedTaskSet()
+
+    for location, kwh_used in scenario['robots']:
+        robot = Robot(location)
+        robot.kwh_used = kwh_used
+        tm.add_robot(robot)
+
+    for index, (src, dst) in enumerate(scenario['tasks']):
+        task = TaskTrolly(src, dst)
+        task.scenario_index = index  # forks copy this along with the task
+        tm.add_task(task)
+
+    return tm
+
+
+# TaskManager -> everything an engine could get wrong, robots by position
+def state(tm):
+    robot_index = {robot: i for i, robot in enumerate(tm.robots)}
+    return (tuple((robot.location, robot.kwh_used,
+                   getattr(robot.current_task, 'scenario_index', None),
+                   type(robot.current_task).__name__,
+                   robot.current_task.subtask_index)
+                  for robot in tm.robots),
+            tuple(sorted(task.scenario_index for task in tm.tasks)),
+            tuple((station, robot_index.get(robot))
+                  for station, robot in tm.charging_stations.items()))
+
+
+def run_reference(scenario):
+    with reference_costs(), mock.patch.object(
+            task_allocation, 'match_robots_to_tasks', reference_match):
+        return trace(build(scenario))
+
+
+def run_fast(scenario):
+    return trace(build(scenario))
+
+
+# carry on from a fork part way through, instead of the original manager
+def run_fork(scenario):
+    tm = build(scenario)
+    states = [state(tm)]
+    while len(states) <= scenario['fork_at'] and not tm.is_finished():
+        tm.tick()
+        states.append(state(tm))
+
+    return states + trace(tm.fork())[1:]
+
+
+# TaskManager -> [state], one per tick until every task is done
+def trace(tm):
+    states = [state(tm)]
+    while not tm.is_finished() and tm.tick_count < MAX_TICKS:
+        tm.tick()
+        states.append(state(tm))
+    return states
+
+
+FAST_PATHS = {
+    'ranked matcher and compiled costs': run_fast,
+    'fork': run_fork,
+}
+
+
+# -> None, or a description of the first difference
+def compare(scenario, run):
+    expected, actual = run_reference(scenario), run(scenario)
+    for tick, (want, got) in enumerate(zip(expected, actual)):
+        if want != got:
+            return "tick %s: expected %s, got %s" % (tick, want, got)
+    if len(expected) != len(actual):
+        return "expected %s ticks, got %s" % (len(expected), len(actual))
+    return None
+
+
+# smallest scenario we can get to that still mismatches
+def shrink(scenario, run):
+    shrunk = True
+    while shrunk:
+        shrunk = False
+        for key in ['robots', 'tasks', 'stations']:
+            for i in range(len(scenario[key])):
+                smaller = dict(scenario)
+                smaller[key] = scenario[key][:i] + scenario[key][i + 1:]
+                if smaller['robots'] and compare(smaller, run) is not None:
+                    scenario, shrunk = smaller, True
+                    break
+    return scenario
+
+
+class TestDifferential(unittest.TestCase):
+    def test_fast_paths_match_reference(self):
+        for name, run in FAST_PATHS.items():
+            for seed in range(SCENARIOS):
+                scenario = random_scenario(seed)
+                mismatch = compare(scenario, run)
+                if mismatch is not None:
+                    smallest = shrink(scenario, run)
+                    self.fail("%s differs for seed %s\n%s\n"
+                              "smallest reproducer: %s\n%s"
+                              % (name, seed, mismatch, smallest,
+                                 compare(smallest, run)))
+
+    def test_reference_never_compiles_costs(self):
+        # a flat robot, so charge tasks get made and matched every tick
+        scenario = {'stations': [1, 8], 'robots': [(3, 60), (5, 0)],
+                    'tasks': [[2, 9], [6, 4]], 'fork_at': 0}
+        with mock.patch.object(TaskBase, 'compile_costs', autospec=True,
+                               side_effect=TaskBase.compile_costs
+                               ) as compile_costs:
+            run_reference(scenario)
+            self.assertEqual(compile_costs.call_count, 0)
+
+            run_fast(scenario)
+            self.assertGreater(compile_costs.call_count, 0)
+
+    def test_shrink(self):
+        # anything with a robot at 7 is "wrong"
+        def run(scenario):
+            if any(location == 7 for location, _ in scenario['robots']):
+                return []
+            return run_fast(scenario)
+
+        scenario = {'stations': [1, 2], 'robots': [(3, 0), (7, 0), (9, 5)],
+                    'tasks': [[1, 2], [3, 4]], 'fork_at': 0}
+        self.assertIsNotNone(compare(scenario, run))
+        self.assertEqual(shrink(scenario, run),
+                         {'stations': [], 'robots': [(7, 0)], 'tasks': [],
+                          'fork_at': 0})
+
+
+# one allocation over a busy store, the first tick is where matching costs
+def time_allocate(compiled_costs, matcher):
+    rnd = random.Random(35)
+    scenario = {
+        'stations': [],
+        'robots': [(rnd.randrange(99), 0) for _ in range(20)],
+        'tasks': [rnd.sample(range(99), 2) for _ in range(300)],
+    }
+    tm = build(scenario)
+
+    with contextlib.ExitStack() as stack:
+        if not compiled_costs:
+            stack.enter_context(reference_costs())
+        stack.enter_context(mock.patch.object(
+            task_allocation, 'match_robots_to_tasks', matcher))
+
+        started = time.perf_counter()
+        tm.allocate()
+        return time.perf_counter() - started
+
+
+# -> {fast path: speedup over the reference}, best of a few runs each
+def measure_speedups(repeat=3):
+    reference = min(time_allocate(False, reference_match)
+                    for _ in range(repeat))
+    fast = min(time_allocate(True, task_allocation.match_robots_to_tasks)
+               for _ in range(repeat))
+    return {'ranked matcher and compiled costs': reference / fast}
+
+
+class TestSpeedup(unittest.TestCase):
+    def test_speedup_above_baseline(self):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+
+        for name, speedup in measure_speedups().items():
+            self.assertGreaterEqual(
+                speedup, baseline[name],
+                "%s is only %.1fx faster than the reference, baseline is "
+                "%.1fx" % (name, speedup, baseline[name]))
+
+
+if __name__ == '__main__':
+    if os.environ.get('RECORD_SPEEDUP_BASELINE'):
+        # keep some headroom so a noisy machine doesnt fail the build
+        speedups = {name: round(speedup / 2, 1)
+                    for name, speedup in measure_speedups().items()}
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(speedups, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("recorded %s" % speedups)
+    else:
+        unittest.main()
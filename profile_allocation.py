@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+import argparse
+import cProfile
+import json
+import pstats
+import sys
+import time
+import tracemalloc
+
+from task_allocation import build_scenario
+
+# in the order TaskManager.tick runs them
+PHASES = ['ingest_tasks', 'allocate', 'advance', 'publish_fleet_state']
+
+
+# TaskManager -> [(phase name, bound method)]
+def tick_phases(tm):
+    return [(name, getattr(tm, name)) for name in PHASES]
+
+
+# [Statistic] -> [{site, size, count}], largest first
+def top_sites(stats, limit):
+    stats = sorted(stats, key=lambda s: s.size_diff, reverse=True)[:limit]
+    return [{'site': "%s:%s" % (s.traceback[-1].filename,
+                                s.traceback[-1].lineno),
+             'size': s.size_diff,
+             'count': s.count_diff}
+            for s in stats if s.size_diff > 0]
+
+
+# only count allocations made on behalf of the task manager, not by us
+def is_task_manager(stat):
+    return any(frame.filename.endswith('task_allocation.py')
+               for frame in stat.traceback)
+
+
+# Snapshot -> {traceback: Statistic}, tracemalloc's own filters and
+# compare_to go through every trace in Python, which made a tick take
+# seconds, so each snapshot is grouped once and filtered per traceback
+def group_snapshot(snapshot):
+    return {stat.traceback: stat
+            for stat in snapshot.statistics('traceback')
+            if is_task_manager(stat)}
+
+
+# grouped snapshot, grouped snapshot -> [StatisticDiff]
+def compare_groups(after, before):
+    empty = tracemalloc.Statistic(None, 0, 0)
+    return [tracemalloc.StatisticDiff(
+                traceback, stat.size, stat.size - old.size,
+                stat.count, stat.count - old.count)
+            for traceback in after.keys() | before.keys()
+            for stat, old in [(after.get(traceback, empty),
+                               before.get(traceback, empty))]]
+
+
+def profile_memory(args):
+    tm = build_scenario(args.seed, args.stations, args.robots, args.tasks)
+    phases = tick_phases(tm)
+
+    # peak_bytes catches short lived allocations, like the robot copies in
+    # calc_costs, the rest only sees what is still alive after each phase
+    report = {name: {'peak_bytes': 0, 'retained_bytes': 0,
+                     'retained_blocks': 0, 'sites': {}}
+              for name in PHASES}
+    blocks_per_tick = []
+    # reset_peak runs before every phase, so the run's peak is the largest
+    # of the phase peaks
+    run_peak = 0
+
+    tracemalloc.start(args.frames)
+    # each phase starts from the snapshot the one before it ended on
+    before = group_snapshot(tracemalloc.take_snapshot())
+    ticks = 0
+    while ticks < args.ticks and not tm.is_finished():
+        tick_blocks = 0
+        for name, phase in phases:
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+
+            phase()
+
+            _, peak = tracemalloc.get_traced_memory()
+            run_peak = max(run_peak, peak)
+            after = group_snapshot(tracemalloc.take_snapshot())
+
+            phase_report = report[name]
+            phase_report['peak_bytes'] = max(phase_report['peak_bytes'],
+                                             peak - start)
+            for stat in compare_groups(after, before):
+                phase_report['retained_bytes'] += stat.size_diff
+                if stat.count_diff > 0:
+                    phase_report['retained_blocks'] += stat.count_diff
+                    tick_blocks += stat.count_diff
+                site = phase_report['sites'].setdefault(
+                    stat.traceback[-1], stat)
+                if site is not stat:
+                    site.size_diff += stat.size_diff
+                    site.count_diff += stat.count_diff
+            before = after
+
+        blocks_per_tick.append(tick_blocks)
+        ticks += 1
+
+    tracemalloc.stop()
+
+    for phase_report in report.values():
+        phase_report['top_sites'] = top_sites(
+            phase_report.pop('sites').values(), args.top)
+        phase_report['retained_blocks_per_tick'] = (
+            phase_report['retained_blocks'] / max(1, ticks))
+
+    return {'ticks': ticks,
+            'peak_bytes': run_peak,
+            'retained_blocks_per_tick': sum(blocks_per_tick) / max(1, ticks),
+            'max_retained_blocks_per_tick': max(blocks_per_tick, default=0),
+            'phases': report}
+
+
+# run the same scenario again without tracemalloc, which would skew timings
+def profile_time(args):
+    tm = build_scenario(args.seed, args.stations, args.robots, args.tasks)
+    profiles = {name: cProfile.Profile() for name in PHASES}
+
+    started = time.perf_counter()
+    ticks = 0
+    while ticks < args.ticks and not tm.is_finished():
+        for name, phase in tick_phases(tm):
+            profiles[name].enable()
+            phase()
+            profiles[name].disable()
+        ticks += 1
+    elapsed = time.perf_counter() - started
+
+    report = {}
+    for name, profile in profiles.items():
+        stats = pstats.Stats(profile).stats
+        top = sorted(stats.items(), key=lambda kv: kv[1][3],
+                     reverse=True)[:args.top]
+        report[name] = {
+            'seconds': sum(s[2] for s in stats.values()),
+            'top_functions': [
+                {'function': "%s:%s(%s)" % func,
+                 'calls': s[1],
+                 'tottime': s[2],
+                 'cumtime': s[3]}
+                for func, s in top]}
+
+    return {'ticks': ticks, 'seconds': elapsed, 'phases': report}
+
+
+# old report, new report -> [message], one per regression
+def compare_reports(old, new, tolerance):
+    regressions = []
+    checks = [('peak_bytes', ['memory', 'peak_bytes']),
+              ('retained_blocks_per_tick',
+               ['memory', 'retained_blocks_per_tick'])]
+    checks += [(name + ' peak_bytes', ['memory', 'phases', name,
+                                       'peak_bytes'])
+               for name in PHASES]
+    checks += [(name + ' retained_blocks_per_tick',
+                ['memory', 'phases', name, 'retained_blocks_per_tick'])
+               for name in PHASES]
+
+    for label, path in checks:
+        old_value, new_value = old, new
+        for key in path:
+            old_value, new_value = old_value[key], new_value[key]
+        if new_value > old_value * (1 + tolerance):
+            regressions.append("%s grew from %s to %s"
+                               % (label, old_value, new_value))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Profile TaskManager.tick allocations and timings")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stations', type=int, default=5)
+    parser.add_argument('--robots', type=int, default=20)
+    parser.add_argument('--tasks', type=int, default=900)
+    parser.add_argument('--ticks', type=int, default=200,
+                        help="stop after this many ticks")
+    parser.add_argument('--top', type=int, default=10,
+                        help="number of allocation sites and functions")
+    parser.add_argument('--frames', type=int, default=4,
+                        help="traceback depth kept by tracemalloc")
+    parser.add_argument('--output', help="write the JSON report here")
+    parser.add_argument('--compare', help="fail on regressions against "
+                                          "this earlier JSON report")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="allowed growth before it is a regression")
+    args = parser.parse_args(argv)
+
+    report = {
+        'scenario': {'seed': args.seed, 'stations': args.stations,
+                     'robots': args.robots, 'tasks': args.tasks,
+                     'ticks': args.ticks},
+        'memory': profile_memory(args),
+        'time': profile_time(args),
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_reports(json.load(f), report,
+                                          args.tolerance)
+        for regression in regressions:
+            print("regression: %s" % regression, file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
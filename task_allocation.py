@@ -1,7 +1,25 @@
 #!/usr/bin/env python3
 
+import argparse
+from array import array
+from collections import deque
 from copy import copy
+import csv
+import heapq
+import inspect
+from itertools import chain, filterfalse
+import logging
 import random
+import sys
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
 
 
 # robot, [tasks] -> (task, (start cost, max power cost))
@@ -16,27 +34,60 @@ def min_cost_task(robot, tasks):
     return min(feasible, key=lambda tc: tc[1], default=(None, None))
 
 
+# robot, [tasks] -> heap of (costs, order, task) for the feasible tasks
+# order is the position in tasks, so ties pop in the order min() picks them
+def rank_tasks(robot, tasks):
+    kwh_available = robot.kwh_available()
+    ranked = []
+    for order, task in enumerate(tasks):
+        costs = task.calc_costs(robot)
+        if kwh_available >= costs[1]:
+            ranked.append((costs, order, task))
+
+    heapq.heapify(ranked)
+    return ranked
+
+
 # [robot], [task] -> [(robot, task)]
 def match_robots_to_tasks(robots_, tasks):
     # copy arguments, we will mutate them
     robots = robots_.copy()
     results = []
 
+    # costs dont change during a call, so rank every robots tasks once
+    # and only drop the ones that have been taken since
+    rankings = {robot: rank_tasks(robot, tasks)
+                for robot in robots} if len(tasks) > 0 else {}
+    taken = set()
+
+    # robot -> (task, (start cost, max power cost)), same as min_cost_task
+    def cheapest_task(robot):
+        ranked = rankings[robot]
+        while ranked and ranked[0][2] in taken:
+            heapq.heappop(ranked)
+        if ranked:
+            costs, _, task = ranked[0]
+            return (task, costs)
+        return (None, None)
+
     while (len(robots) > 0 and len(tasks) > 0):
         # calc lowest cost task for each robot
         # [(r, (t, c)),...]
         # [(r, None)...]
-        task_costs = map(lambda r: (r, min_cost_task(r, tasks)),
-                         robots)
+        task_costs = map(lambda r: (r, cheapest_task(r)), robots)
 
         # choose pair with highest cost of set of lowest costs
-        robot, (task, _) = max(task_costs, key=lambda z: z[1][1])
+        # robots with nothing feasible go last, they cant be compared
+        robot, (task, _) = max(task_costs,
+                               key=lambda z: (z[1][1] is not None,
+                                              z[1][1] or ()))
 
         # a task is returned if its feasible
         if task is not None:
             # add chosen pair to result set
             results.append((robot, task))
             tasks.remove(task)
+            taken.add(task)
 
         robots.remove(robot)
 
@@ -74,26 +125,31 @@ class SubTaskCharging:
     # all robots charge 1kwh / 1 unit time
     kwh_per_tick = -1
 
+    # target is the kwh_used we stop at, 0 is a full charge
+    def __init__(self, target=0):
+        self.target = target
+
     def tick(self, robot):
         # lets not overcharge
-        if (robot.kwh_used + self.kwh_per_tick < 0):
-            robot.kwh_used = 0
+        if (robot.kwh_used + self.kwh_per_tick < self.target):
+            robot.kwh_used = self.target
         else:
             robot.kwh_used += self.kwh_per_tick
 
     # robot -> (time_cost, power_cost)
     def calc_cost(self, mutable_robot):
         # conveniently, all robots charge at same rate
-        time = max(0, mutable_robot.kwh_used)
+        time = max(0, mutable_robot.kwh_used - self.target)
         power = time * self.kwh_per_tick
 
         # update robot with resouce usage
-        mutable_robot.kwh_used = 0  # recharged
+        mutable_robot.kwh_used = min(mutable_robot.kwh_used,
+                                     self.target)  # recharged
 
         return (time, power)
 
     def is_done(self, robot):
-        return robot.kwh_used <= 0
+        return robot.kwh_used <= self.target
 
 
 class SubTaskAttaching:
@@ -130,6 +186,7 @@ class TaskBase:
     def __init__(self):
         self.subtasks = []
         self.subtask_index = 0
+        self.cost_kernel = None  # filled in by the first calc_costs
 
     def tick(self, robot):
         if len(self.subtasks) > self.subtask_index:
@@ -142,8 +199,31 @@ class TaskBase:
             return subtask
         return None
 
+    # -> (first driving subtask, positive power costs of the rest) or False
+    # once a task has started by driving somewhere the rest of it costs the
+    # same whichever robot does it, so we only work that out once
+    def compile_costs(self):
+        if (len(self.subtasks) == 0
+                or not isinstance(self.subtasks[0], SubTaskDriving)):
+            return False
+
+        robot = Robot(self.subtasks[0].destination)
+        costs = [st.calc_cost(robot) for st in self.subtasks[1:]]
+        return (self.subtasks[0], tuple([c[1] for c in costs if c[1] > 0]))
+
     # robot -> (start_time_cost, max_power_cost)
     def calc_costs(self, robot_):
+        if self.cost_kernel is None:
+            self.cost_kernel = self.compile_costs()
+
+        if self.cost_kernel:
+            first, tail = self.cost_kernel
+            time = abs(robot_.location - first.destination)
+            power = time * first.kwh_per_tick
+
+            # summed in the same order as below, so costs are identical
+            return (time, sum((power,) + tail if power > 0 else tail))
+
         robot = copy(robot_)  # robot is mutatated during calculation
         costs = [st.calc_cost(robot) for st in self.subtasks]
 
@@ -155,16 +235,31 @@ class TaskBase:
 
         return (time_to_first_subtask, max_kwh_used)
 
+    # robot -> (remaining_time_cost, remaining_power_cost)
+    def calc_remaining_costs(self, robot_):
+        robot = copy(robot_)  # robot is mutatated during calculation
+        costs = [st.calc_cost(robot)
+                 for st in self.subtasks[self.subtask_index:]]
+
+        return (sum([c[0] for c in costs]), sum([c[1] for c in costs]))
+
+    # robot -> where robot will be once the task is done
+    def end_location(self, robot):
+        for subtask in reversed(self.subtasks[self.subtask_index:]):
+            if isinstance(subtask, SubTaskDriving):
+                return subtask.destination
+        return robot.location
+
     def is_standby(self):
         return False
 
 
 class TaskCharge(TaskBase):
-    def __init__(self, station):
+    def __init__(self, station, target=0):
         super().__init__()
         self.subtasks = [
                 SubTaskDriving(station),
-                SubTaskCharging()]
+                SubTaskCharging(target)]
 
     def get_station(self):
         return self.subtasks[0].destination
@@ -198,6 +293,120 @@ class TaskTrolly(TaskBase):
         return self.__str__()
 
 
+# step name -> subtask, parameters of a step are passed to the subtask
+STEP_TYPES = {
+    'drive': SubTaskDriving,
+    'attach': SubTaskAttaching,
+    'detach': SubTaskDetaching,
+    'charge': SubTaskCharging,
+}
+
+
+# a task type described as steps instead of a TaskBase subclass, e.g.
+# TaskDefinition('trolly', [('drive', 'source'), ('attach',),
+#                           ('drive', 'destination'), ('detach',)])
+# note charge steps dont reserve a station, only TaskCharge does that
+class TaskDefinition:
+    def __init__(self, name, steps):
+        if len(steps) == 0:
+            raise ValueError("%s has no steps" % name)
+        for step in steps:
+            if step[0] not in STEP_TYPES:
+                raise ValueError("unknown step %r in %s" % (step[0], name))
+            try:
+                inspect.signature(STEP_TYPES[step[0]]).bind(*step[1:])
+            except TypeError:
+                raise ValueError("wrong parameters for %r in %s: %s"
+                                 % (step[0], name, step[1:])) from None
+        # tasks are matched by where they start and zones file them there
+        if steps[0][0] != 'drive':
+            raise ValueError("%s must start by driving somewhere" % name)
+
+        self.name = name
+        self.steps = [(STEP_TYPES[step[0]], step[1:]) for step in steps]
+        self.params = sorted(set(p for _, ps in self.steps for p in ps))
+
+        # the cost kernel's tail in terms of parameters, a (from, to) pair
+        # for each leg driven after the first and the fixed power of every
+        # attach or detach, charge steps never cost power so are left out
+        self.tail = []
+        location = steps[0][1]
+        for subtask, ps in self.steps[1:]:
+            if subtask is SubTaskDriving:
+                self.tail.append((location, ps[0]))
+                location = ps[0]
+            elif subtask is not SubTaskCharging:
+                self.tail.append(subtask.kwh_per_tick)
+
+    # **params -> TaskPipeline
+    def create(self, **params):
+        if set(params) != set(self.params):
+            raise ValueError("%s takes %s, got %s"
+                             % (self.name, self.params, sorted(params)))
+
+        subtasks = [subtask(*[params[p] for p in ps])
+                    for subtask, ps in self.steps]
+        task = TaskPipeline(self, params, subtasks)
+
+        # the same costs compile_costs would work out, without a robot
+        costs = [abs(params[term[0]] - params[term[1]])
+                 * SubTaskDriving.kwh_per_tick
+                 if isinstance(term, tuple) else term for term in self.tail]
+        task.cost_kernel = (subtasks[0], tuple([c for c in costs if c > 0]))
+        return task
+
+
+class TaskPipeline(TaskBase):
+    def __init__(self, definition, params, subtasks):
+        super().__init__()
+        self.definition = definition
+        self.params = params
+        self.subtasks = subtasks
+
+        # (subtask class, destination, target or power per tick) per step
+        self.step_table = [
+            (type(st), getattr(st, 'destination', None),
+             st.target if type(st) is SubTaskCharging else st.kwh_per_tick)
+            for st in subtasks]
+
+    # same as TaskBase.tick, but reads the step table instead of calling
+    # each subtask's tick and is_done
+    def tick(self, robot):
+        index = self.subtask_index
+        if index >= len(self.step_table):
+            return None
+
+        kind, destination, value = self.step_table[index]
+        if kind is SubTaskDriving:
+            robot.kwh_used += value
+            robot.location += 1 if robot.location < destination else -1
+            done = robot.location == destination
+        elif kind is SubTaskCharging:
+            # lets not overcharge
+            if robot.kwh_used + SubTaskCharging.kwh_per_tick < value:
+                robot.kwh_used = value
+            else:
+                robot.kwh_used += SubTaskCharging.kwh_per_tick
+            done = robot.kwh_used <= value
+        else:
+            robot.kwh_used += value
+            done = True
+
+        if done:
+            self.subtask_index = index + 1
+        return self.subtasks[index]
+
+    def __str__(self):
+        return "TaskPipeline %s %s %s" % (
+            id(self),
+            self.definition.name,
+            " ".join("%s: %s" % kv for kv in sorted(self.params.items()))
+        )
+
+    def __repr__(self):
+        return self.__str__()
+
+
 class TaskStandby(TaskBase):
     def __init__(self):
         super().__init__()
@@ -237,10 +446,17 @@ class Robot:
 
     def assign_task(self, task):
         if not self.is_idle():
-            print("interrupting current task")
+            log.warning("interrupting current task")
 
         self.current_task = task
 
+    # copy for a TaskManager fork, the task is copied too as it keeps track
+    # of how far through it we are, subtasks have no state and are shared
+    def fork(self):
+        robot = copy(self)
+        robot.current_task = copy(self.current_task)
+        return robot
+
     def kwh_available(self):
         return min(self.kwh_max, max(0, self.kwh_max - self.kwh_used))
 
@@ -250,6 +466,14 @@ class Robot:
     def needs_charge(self):
         return self.kwh_available() < 50.5  # we charge when half flat
 
+    # kwh we expect to have left once the current task is done
+    def kwh_forecast(self):
+        _, power = self.current_task.calc_remaining_costs(self)
+        return min(self.kwh_max, max(0, self.kwh_available() - power))
+
+    def needs_charge_soon(self):
+        return self.kwh_forecast() < 50.5
+
     def __str__(self):
         return "Robot %s loc: %s chrg: %skwh %s" % (
             id(self),
@@ -262,17 +486,344 @@ class Robot:
         return self.__str__()
 
 
-class TaskManager:
-    def __init__(self, charging_stations):
+# fixed set of typed columns, rows are preallocated in blocks so recording
+# a row is a handful of array stores
+class ResultsTable:
+    # [(name, array typecode)]
+    def __init__(self, columns, capacity=1024):
+        self.typecodes = dict(columns)
+        self.names = [name for name, _ in columns]
+        self.capacity = max(1, capacity)
+        self.rows = 0
+        self.columns = {name: self.new_column(name, self.capacity)
+                        for name in self.names}
+
+    def new_column(self, name, rows):
+        column = array(self.typecodes[name])
+        # -1 marks values that were never recorded
+        column.frombytes(array(self.typecodes[name], [-1]).tobytes() * rows)
+        return column
+
+    def add_row(self):
+        if self.rows == self.capacity:
+            for name in self.names:
+                self.columns[name].extend(
+                    self.new_column(name, self.capacity))
+            self.capacity *= 2
+
+        self.rows += 1
+        return self.rows - 1
+
+    # name -> array of only the rows recorded so far
+    def column(self, name):
+        return self.columns[name][:self.rows]
+
+    def write_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.names)
+            writer.writerows(zip(*[self.column(n) for n in self.names]))
+
+
+class ResultsCollector:
+    task_columns = [('added_tick', 'q'), ('assigned_tick', 'q'),
+                    ('completed_tick', 'q'), ('wait_ticks', 'q'),
+                    ('distance', 'q'), ('kwh_used', 'd')]
+    robot_columns = [('distance', 'q'), ('kwh_used', 'd'),
+                     ('kwh_charged', 'd'), ('busy_ticks', 'q'),
+                     ('charge_wait_ticks', 'q')]
+    station_columns = [('location', 'q'), ('occupied_ticks', 'q')]
+
+    def __init__(self, task_capacity=1024, robot_capacity=64,
+                 station_capacity=16):
+        self.tasks = ResultsTable(self.task_columns, task_capacity)
+        self.robots = ResultsTable(self.robot_columns, robot_capacity)
+        self.stations = ResultsTable(self.station_columns, station_capacity)
+
+        # rows live here rather than on the robots and tasks, a fork shares
+        # tasks with its parent and both may be collecting
+        self.robot_rows = {}
+        self.task_rows = {}
+        self.station_rows = {}
+
+    def robot_added(self, robot):
+        row = self.robot_rows[robot] = self.robots.add_row()
+        for name in ['distance', 'kwh_used', 'kwh_charged', 'busy_ticks',
+                     'charge_wait_ticks']:
+            self.robots.columns[name][row] = 0
+
+    def station_added(self, station):
+        row = self.stations.add_row()
+        self.stations.columns['location'][row] = station
+        self.stations.columns['occupied_ticks'][row] = 0
+        self.station_rows[station] = row
+
+    def task_added(self, task, tick):
+        row = self.task_rows[task] = self.tasks.add_row()
+        self.tasks.columns['added_tick'][row] = tick
+        self.tasks.columns['distance'][row] = 0
+        self.tasks.columns['kwh_used'][row] = 0
+
+    # task as it was added, task the robot was given, which is a copy of it
+    # when a fork hands out a task it shares with its parent
+    def task_assigned(self, task, claimed, tick):
+        columns = self.tasks.columns
+        row = self.task_rows[claimed] = self.task_rows.pop(task)
+        columns['assigned_tick'][row] = tick
+        columns['wait_ticks'][row] = tick - columns['added_tick'][row]
+
+    # robot, task it was doing, what robot.tick returned and the location
+    # and kwh_used from before the tick
+    def robot_ticked(self, robot, task, subtask, location, kwh_used, tick):
+        row = self.robot_rows[robot]
+        distance = abs(robot.location - location)
+        kwh = robot.kwh_used - kwh_used
+
+        self.robots.columns['distance'][row] += distance
+        if kwh > 0:
+            self.robots.columns['kwh_used'][row] += kwh
+        else:
+            self.robots.columns['kwh_charged'][row] -= kwh
+
+        if task.is_standby():
+            if robot.needs_charge():
+                self.robots.columns['charge_wait_ticks'][row] += 1
+            return
+
+        # the task finished last tick, this one only swapped it for standby
+        if subtask is None:
+            task_row = self.task_rows.pop(task, None)
+            if task_row is not None:
+                self.tasks.columns['completed_tick'][task_row] = tick - 1
+            return
+
+        self.robots.columns['busy_ticks'][row] += 1
+
+        task_row = self.task_rows.get(task)
+        if task_row is not None:
+            self.tasks.columns['distance'][task_row] += distance
+            self.tasks.columns['kwh_used'][task_row] += kwh
+
+    # stations can be added to charging_stations at any time, so any we
+    # have not seen yet are added here
+    def stations_ticked(self, charging_stations):
+        for station, robot in charging_stations.items():
+            if station not in self.station_rows:
+                self.station_added(station)
+            if robot is not None:
+                row = self.station_rows[station]
+                self.stations.columns['occupied_ticks'][row] += 1
+
+    # prefix -> prefix_tasks.csv, prefix_robots.csv, prefix_stations.csv
+    def write_csv(self, prefix):
+        for name in ['tasks', 'robots', 'stations']:
+            getattr(self, name).write_csv("%s_%s.csv" % (prefix, name))
+
+    # needs numpy, one array per column named table_column
+    def write_npz(self, path):
+        if numpy is None:
+            raise RuntimeError("numpy is needed to write .npz results")
+
+        arrays = {}
+        for name in ['tasks', 'robots', 'stations']:
+            table = getattr(self, name)
+            for column in table.names:
+                arrays["%s_%s" % (name, column)] = numpy.frombuffer(
+                    table.column(column),
+                    dtype=numpy.dtype(table.typecodes[column]))
+        numpy.savez(path, **arrays)
+
+
+# set of tasks that iterates in insertion order, a fork copies its tasks
+# into one so it matches them in the same order as the manager it came from
+class OrderedTaskSet(dict):
+    def add(self, task):
+        self[task] = None
+
+    def remove(self, task):
+        del self[task]
+
+
+# tasks a fork shares with the manager it came from, each keeps its own
+# removals and additions on top of a base that neither of them changes, so
+# a fork costs the changes since the last fork rather than every task
+class SharedTaskSet:
+    def __init__(self, base, removed=(), added=()):
+        self.base = base
+        self.removed = set(removed)
+        self.added = OrderedTaskSet.fromkeys(added)
+
+    def fork(self):
+        return SharedTaskSet(self.base, self.removed, self.added)
+
+    # base order then added order, the same order an OrderedTaskSet
+    # holding the same tasks would have
+    def __iter__(self):
+        if not self.removed:
+            return chain(self.base, self.added)
+        return chain(filterfalse(self.removed.__contains__, self.base),
+                     self.added)
+
+    def __len__(self):
+        return len(self.base) - len(self.removed) + len(self.added)
+
+    def __contains__(self, task):
+        return task in self.added or (task in self.base
+                                      and task not in self.removed)
+
+    def add(self, task):
+        if task in self.base:
+            self.removed.discard(task)
+        else:
+            self.added.add(task)
+
+    def remove(self, task):
+        if task in self.added:
+            self.added.remove(task)
+        elif task in self.base and task not in self.removed:
+            self.removed.add(task)
+            # once most of the base is gone, skipping it costs more than a
+            # base of our own, which the removals so far have paid for
+            if len(self.removed) > len(self.base) // 2:
+                self.base = OrderedTaskSet.fromkeys(self)
+                self.removed, self.added = set(), OrderedTaskSet()
+        else:
+            raise KeyError(task)
+
+
+# what TaskManager and ZonedTaskManager have in common, a queue other
+# threads submit tasks to and showing the robots, subclasses provide
+# add_task, robots and tick
+class TaskManagerBase:
+    # submit_task blocks once this many tasks are waiting to be ingested
+    max_pending_tasks = 10000
+
+    def __init__(self):
+        # deque appends and pops are atomic, so producers never take a lock
+        # the semaphore only bounds how far they can get ahead of tick
+        self.pending_tasks = deque()
+        self.pending_slots = threading.Semaphore(self.max_pending_tasks)
+
+    # thread safe, the task is picked up at the start of the next tick
+    # returns False if the queue stayed full for timeout seconds
+    def submit_task(self, task, timeout=None):
+        if not self.pending_slots.acquire(timeout=timeout):
+            return False
+        self.pending_tasks.append(task)
+        return True
+
+    # add_task everything submitted so far, only called from tick
+    def ingest_tasks(self):
+        count = 0
+        try:
+            while True:
+                self.add_task(self.pending_tasks.popleft())
+                count += 1
+        except IndexError:
+            pass
+
+        if count:
+            self.pending_slots.release(count)
+        return count
+
+    def format_robots(self):
+        return "\n".join(["==== Robots ===="] + [str(r) for r in self.robots])
+
+    def show_robots(self):
+        print(self.format_robots())
+
+
+class TaskManager(TaskManagerBase):
+    # top ups are partial, a robot gives the station back after this much
+    top_up_kwh = 20
+    # not worth driving to a station for less than this
+    top_up_min_kwh = 5
+
+    def __init__(self, charging_stations, top_up=False):
+        super().__init__()
         self.charging_stations = charging_stations
         self.robots = []
         self.tasks = set()
+        self.top_up = top_up
+
+        # [(location, kwh_available, is_idle)], replaced wholesale each tick
+        # so readers on other threads always see a consistent fleet
+        self.fleet_state = ()
+
+        # {station: robot}, free stations held back for a working robot that
+        # will be flat when its task is done, only top ups make these
+        self.reservations = {}
+
+        # {station: TaskCharge} offered to flat robots, kept until one is
+        # handed out so its costs are not compiled again every tick
+        self.charge_tasks = {}
+
+        self.tick_count = 0
+        self.results = None
+
+        # forks share unassigned tasks with their parent
+        self.copy_on_assign = False
+
+    # independent copy of the manager for what-if runs, robots are copied
+    # as every one of them changes on the fork's first tick anyway, tasks
+    # are shared and only copied when the fork hands one out, tasks still
+    # waiting in submit_task's queue are not part of the fork
+    def fork(self):
+        # from now on we keep our changes to the tasks to ourselves too
+        if not isinstance(self.tasks, SharedTaskSet):
+            self.tasks = SharedTaskSet(
+                self.tasks if isinstance(self.tasks, OrderedTaskSet)
+                else OrderedTaskSet.fromkeys(self.tasks))
+
+        forked = TaskManager({}, self.top_up)
+        robots = {robot: robot.fork() for robot in self.robots}
+
+        forked.robots = list(robots.values())
+        forked.tasks = self.tasks.fork()
+        forked.charging_stations = {
+            station: robots.get(robot, robot)
+            for station, robot in self.charging_stations.items()}
+        forked.reservations = {station: robots.get(robot, robot)
+                               for station, robot in self.reservations.items()}
+        forked.tick_count = self.tick_count
+        forked.copy_on_assign = True
+
+        return forked
+
+    # task -> task for a robot to work on
+    def claim_task(self, task):
+        if not self.copy_on_assign:
+            return task
+
+        task = copy(task)
+        task.subtask_index = 0  # the parent may have started it since
+        return task
+
+    # start recording KPIs for robots, tasks and stations into collector
+    def collect_results(self, collector):
+        self.results = collector
+        for robot in self.robots:
+            collector.robot_added(robot)
+        for task in self.tasks:
+            collector.task_added(task, self.tick_count)
+        for station in self.charging_stations:
+            collector.station_added(station)
 
     def add_robot(self, robot):
         self.robots.append(robot)
+        if self.results is not None:
+            self.results.robot_added(robot)
 
+    # not thread safe, use submit_task while tick may be running
     def add_task(self, task):
         self.tasks.add(task)
+        if self.results is not None:
+            self.results.task_added(task, self.tick_count)
+
+    def publish_fleet_state(self):
+        self.fleet_state = tuple(
+            (robot.location, robot.kwh_available(), robot.is_idle())
+            for robot in self.robots)
 
     def get_idle_robots(self):
         flat_robots, work_robots = [], []
@@ -285,75 +836,400 @@ class TaskManager:
 
         return flat_robots, work_robots
 
+    def charge_task(self, station):
+        task = self.charge_tasks.get(station)
+        if task is None:
+            task = self.charge_tasks[station] = TaskCharge(station)
+        return task
+
     def get_free_charge_tasks(self):
-        return [TaskCharge(station)
+        return [self.charge_task(station)
                 for station, robot in self.charging_stations.items()
+                if robot is None and station not in self.reservations]
+
+    # -> {station: ticks until the station is free}
+    def forecast_stations(self):
+        return {station: 0 if robot is None
+                else robot.current_task.calc_remaining_costs(robot)[0]
+                for station, robot in self.charging_stations.items()}
+
+    # working robots that will want a station when their task is done
+    def get_soon_flat_robots(self):
+        return [robot for robot in self.robots
+                if not robot.is_idle()
+                and not isinstance(robot.current_task, TaskCharge)
+                and robot.needs_charge_soon()]
+
+    # soon flat robots that no occupied station is forecast to free up for
+    # before their task is done, the soonest finishing take the soonest
+    # freed stations first
+    def get_uncovered_robots(self, soon_flat):
+        forecast = self.forecast_stations()
+        freeing = sorted(forecast[station] for station, robot
+                         in self.charging_stations.items()
+                         if robot is not None)
+
+        finishing = sorted(
+            [(robot.current_task.calc_remaining_costs(robot)[0], i, robot)
+             for i, robot in enumerate(soon_flat)])
+
+        uncovered = []
+        for remaining, _, robot in finishing:
+            if freeing and freeing[0] <= remaining:
+                freeing.pop(0)
+            else:
+                uncovered.append(robot)
+
+        return uncovered
+
+    # reserve the free station nearest where each robot we forecast will go
+    # flat finishes, less those an occupied station will be free for in
+    # time, then send robots with nothing to do to top up at what is left
+    def top_up_robots(self, idle_robots):
+        free = [station for station, robot in self.charging_stations.items()
                 if robot is None]
 
-    def tick(self):
+        self.reservations = {}
+        for robot in self.get_uncovered_robots(self.get_soon_flat_robots()):
+            if not free:
+                break
+            end = robot.current_task.end_location(robot)
+            station = min(free, key=lambda s: abs(end - s))
+            free.remove(station)
+            self.reservations[station] = robot
+
+        top_up_robots = [robot for robot in idle_robots
+                         if robot.kwh_used >= self.top_up_min_kwh]
+        for robot, task in match_robots_to_tasks(
+                top_up_robots, [self.charge_task(s) for s in free]):
+            task = TaskCharge(task.get_station(),
+                              max(0, robot.kwh_used - self.top_up_kwh))
+            robot.assign_task(task)
+            self.charging_stations[task.get_station()] = robot
+
+    # robots that went flat get the station reserved for them, if they are
+    # done and did not need it after all the station goes back to everyone
+    def claim_reservations(self, flat_robots):
+        for station, robot in list(self.reservations.items()):
+            if not robot.is_idle():
+                continue
+            del self.reservations[station]
+            if robot in flat_robots:
+                flat_robots.remove(robot)
+                robot.assign_task(TaskCharge(station))
+                self.charging_stations[station] = robot
+
+    # hand out charge and work tasks to idle robots
+    def allocate(self):
         flat_robots, work_robots = self.get_idle_robots()
+        self.claim_reservations(flat_robots)
         charge_tasks = self.get_free_charge_tasks()
 
         for robot, task in match_robots_to_tasks(flat_robots, charge_tasks):
-            robot.assign_task(task)
+            robot.assign_task(self.charge_tasks.pop(task.get_station()))
             self.charging_stations[task.get_station()] = robot
 
         for robot, task in match_robots_to_tasks(work_robots, self.tasks):
-            robot.assign_task(task)
+            claimed = self.claim_task(task)
+            robot.assign_task(claimed)
+            if self.results is not None:
+                self.results.task_assigned(task, claimed, self.tick_count)
 
-        # march time forward
+        if self.top_up:
+            self.top_up_robots([r for r in work_robots if r.is_idle()])
+
+    # march time forward
+    def advance(self):
+        results = self.results
         ticks = []
         for robot in self.robots:
+            if results is not None:
+                task, location, kwh_used = (robot.current_task,
+                                            robot.location, robot.kwh_used)
+
             subtask = robot.tick()
             ticks.append((robot, subtask))
 
+            if results is not None:
+                results.robot_ticked(robot, task, subtask, location,
+                                     kwh_used, self.tick_count)
+
             # finished charging, free up the station
             if isinstance(subtask, SubTaskCharging):
                 if subtask.is_done(robot):
                     station = robot.current_task.get_station()
                     self.charging_stations[station] = None
 
+        if results is not None:
+            results.stations_ticked(self.charging_stations)
+
+        self.tick_count += 1
         return ticks
 
-    def show_robots(self):
-        print("==== Robots ====")
-        for robot in self.robots:
-            print(robot)
+    def tick(self):
+        self.ingest_tasks()
+        self.allocate()
+        ticks = self.advance()
+        self.publish_fleet_state()
+        return ticks
 
+    def is_finished(self):
+        return (len(self.tasks) == 0 and len(self.pending_tasks) == 0
+                and all(robot.is_idle() for robot in self.robots))
 
-if __name__ == '__main__':
 
-    # five charging stations
-    QTY_STATIONS = 5
+# splits the store into zones of zone_size locations, each with its own
+# TaskManager, so matching only ever looks at one zone's robots and tasks,
+# zones still tick one after another so a tick costs the sum of them
+class ZonedTaskManager(TaskManagerBase):
+    def __init__(self, charging_stations, zone_size, top_up=False):
+        # zones are only created on the tick thread, so submitted tasks
+        # wait in our queue until tick hands them to their zone
+        super().__init__()
+        self.zone_size = zone_size
+        self.top_up = top_up
+        self.zones = {}
+
+        for station, robot in charging_stations.items():
+            self.get_zone(station).charging_stations[station] = robot
+
+    def zone_of(self, location):
+        return location // self.zone_size
+
+    def get_zone(self, location):
+        key = self.zone_of(location)
+        if key not in self.zones:
+            self.zones[key] = TaskManager({}, self.top_up)
+        return self.zones[key]
+
+    @property
+    def robots(self):
+        return [robot for key in sorted(self.zones)
+                for robot in self.zones[key].robots]
+
+    @property
+    def tasks(self):
+        return set().union(*[zone.tasks for zone in self.zones.values()])
+
+    @property
+    def charging_stations(self):
+        return {station: robot for zone in self.zones.values()
+                for station, robot in zone.charging_stations.items()}
+
+    def add_robot(self, robot):
+        self.get_zone(robot.location).add_robot(robot)
+
+    # tasks belong to the zone they start in
+    def add_task(self, task):
+        self.get_zone(task.subtasks[0].destination).add_task(task)
+
+    def move_robot(self, robot, from_key, to_key):
+        self.zones[from_key].robots.remove(robot)
+        self.get_zone(to_key * self.zone_size).robots.append(robot)
+
+    # idle robots first go back to the zone they are in now, tasks may have
+    # taken them anywhere, then they are handed from zones with nothing to
+    # do to the nearest zone with a backlog, and flat robots a zone has no
+    # free station for go to the nearest zone that has one, or failing that
+    # the nearest zone with stations if theirs has none
+    def rebalance(self):
+        # flat robots stay wherever they were sent to charge
+        moves = [(robot, key, self.zone_of(robot.location))
+                 for key, zone in self.zones.items()
+                 for robot in zone.robots
+                 if robot.is_idle() and not robot.needs_charge()
+                 and self.zone_of(robot.location) != key]
+        for robot, from_key, to_key in moves:
+            self.move_robot(robot, from_key, to_key)
+
+        free = {key: len(zone.get_free_charge_tasks())
+                for key, zone in self.zones.items()
+                if zone.charging_stations}
+
+        spare, backlog, waiting = {}, {}, []
+        for key, zone in self.zones.items():
+            flat_robots, work_robots = zone.get_idle_robots()
+            if len(work_robots) > len(zone.tasks):
+                spare[key] = work_robots[len(zone.tasks):]
+            elif len(zone.tasks) > len(work_robots):
+                backlog[key] = len(zone.tasks) - len(work_robots)
+
+            # the zone's own free stations go to its own flat robots first
+            staying = min(len(flat_robots), free.get(key, 0))
+            if key in free:
+                free[key] -= staying
+            waiting.extend((robot, key) for robot in flat_robots[staying:])
+
+        for robot, from_key in waiting:
+            if not free:
+                break
+            to_key = min(free, key=lambda k: (free[k] == 0,
+                                              abs(k - from_key)))
+            if free[to_key] > 0:
+                free[to_key] -= 1
+            elif from_key in free:
+                continue  # no station free anywhere, wait for our own
+            self.move_robot(robot, from_key, to_key)
+
+        for to_key in sorted(backlog, key=backlog.get, reverse=True):
+            while backlog[to_key] > 0 and spare:
+                from_key = min(spare, key=lambda k: abs(k - to_key))
+                self.move_robot(spare[from_key].pop(), from_key, to_key)
+                backlog[to_key] -= 1
+                if not spare[from_key]:
+                    del spare[from_key]
+
+    def tick(self):
+        self.ingest_tasks()
+        self.rebalance()
+
+        ticks = []
+        for key in sorted(self.zones):
+            ticks.extend(self.zones[key].tick())
+        return ticks
+
+
+# seed -> TaskManager, the same seed always builds the same store
+def build_scenario(seed=None, qty_stations=5, qty_robots=20, qty_tasks=900,
+                   store_size=99, top_up=False):
+    rnd = random.Random(seed)
+
     charging_stations = {
-        k: None for k in random.sample(range(0, 99), QTY_STATIONS)
+        k: None for k in rnd.sample(range(0, store_size), qty_stations)
     }
-    print(charging_stations)
-
-    tm = TaskManager(charging_stations)
+    tm = TaskManager(charging_stations, top_up)
+    # ties between equal cost tasks go to whichever comes first, a set would
+    # order them by id and a seed would not give the same run twice
+    tm.tasks = OrderedTaskSet()
 
-    # some number of robots robots
-    QTY_ROBOTS = 20
-    for location in random.sample(range(0, 99), QTY_ROBOTS):
+    for location in rnd.sample(range(0, store_size), qty_robots):
         tm.add_robot(Robot(location))
 
-    # a few hundred tasks
-    QTY_TASKS = 900
-    for _ in range(QTY_TASKS):
-        src, dst = random.sample(range(0, 99), 2)
+    for _ in range(qty_tasks):
+        src, dst = rnd.sample(range(0, store_size), 2)
         tm.add_task(TaskTrolly(src, dst))
 
-    tm.show_robots()
+    return tm
+
+
+# argparse type for counts where negative numbers make no sense
+def non_negative_int(text):
+    value = int(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError("%s is negative" % text)
+    return value
+
+
+# argv -> exit code, runs a seeded scenario until every task is done
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Simulate robots working through trolly tasks")
+    parser.add_argument('--seed', type=int, help="same seed, same store")
+    parser.add_argument('--stations', type=int, default=5)
+    parser.add_argument('--robots', type=int, default=20)
+    parser.add_argument('--tasks', type=int, default=900)
+    parser.add_argument('--store-size', type=int, default=99,
+                        help="number of locations in the store")
+    parser.add_argument('--top-up', action='store_true',
+                        help="top up idle robots at free stations")
+    parser.add_argument('--max-ticks', type=int,
+                        help="give up after this many ticks")
+    parser.add_argument('--every', type=non_negative_int, default=1,
+                        help="show the robots every N ticks, 0 for never")
+    parser.add_argument('--progress', type=float, default=0,
+                        help="report progress at most every N seconds")
+    parser.add_argument('--headless', action='store_true',
+                        help="only print the summary")
+    parser.add_argument('--buffer-lines', type=non_negative_int,
+                        default=10000,
+                        help="lines of output to hold before writing")
+    parser.add_argument('--results', metavar='PREFIX',
+                        help="write KPIs to PREFIX_tasks.csv and so on, or "
+                             "to PREFIX if it ends in .npz")
+    args = parser.parse_args(argv)
+
+    if args.headless:
+        args.every = 0
+
+    # writing every line as we go costs more than the simulation does
+    buffer = []
+
+    def flush():
+        if buffer:
+            sys.stdout.write("\n".join(buffer) + "\n")
+            sys.stdout.flush()
+            buffer.clear()
+
+    def emit(text):
+        buffer.append(text)
+        if len(buffer) >= args.buffer_lines:
+            flush()
+
+    # messages from the simulation go through the same buffer, or nowhere
+    class BufferHandler(logging.Handler):
+        def emit(self, record):
+            emit(self.format(record))
+
+    handler = logging.NullHandler() if args.headless else BufferHandler()
+    log.addHandler(handler)
+    log.propagate = False
+    try:
+        return simulate(args, emit, flush)
+    finally:
+        log.removeHandler(handler)
+        log.propagate = True
+
+
+# runs the scenario for main, robot output goes through emit
+def simulate(args, emit, flush):
+    tm = build_scenario(args.seed, args.stations, args.robots, args.tasks,
+                        args.store_size, args.top_up)
+    if args.results:
+        results = ResultsCollector()
+        tm.collect_results(results)
+
+    if args.every:
+        emit(str(tm.charging_stations))
+        emit(tm.format_robots())
+
+    started = last_progress = time.perf_counter()
+    while not tm.is_finished():
+        if args.max_ticks is not None and tm.tick_count >= args.max_ticks:
+            break
+
+        tm.tick()
+
+        if args.every and tm.tick_count % args.every == 0:
+            emit(tm.format_robots())
+
+        if args.progress:
+            now = time.perf_counter()
+            if now - last_progress >= args.progress:
+                last_progress = now
+                flush()
+                print("tick %s, %s tasks left, %.0f ticks/s"
+                      % (tm.tick_count, len(tm.tasks),
+                         tm.tick_count / (now - started)),
+                      file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    flush()
+
+    if args.results and args.results.endswith('.npz'):
+        results.write_npz(args.results)
+    elif args.results:
+        results.write_csv(args.results)
+
+    if tm.is_finished():
+        print("Completed %s tasks with %s robots in %s ticks"
+              % (args.tasks, args.robots, tm.tick_count))
+    else:
+        print("Stopped after %s ticks with %s tasks left"
+              % (tm.tick_count, len(tm.tasks)))
+    print("Simulated %s ticks in %.3fs, %.0f ticks/s"
+          % (tm.tick_count, elapsed, tm.tick_count / max(elapsed, 1e-9)))
+
+    return 0
 
-    tick_count = 0
-    while True:
-        step = tm.tick()
-        tick_count += 1
-        tm.show_robots()
-        if len(tm.tasks) == 0:
-            if all(isinstance(robot.current_task, TaskStandby)
-                    for (robot, _) in step):
-                break
 
-    print("Completed %s tasks with %s robots in %s ticks"
-          % (QTY_TASKS, QTY_ROBOTS, tick_count))
+if __name__ == '__main__':
+    sys.exit(main())
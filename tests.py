@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
 
+import contextlib
+import csv
+import io
+import os
+import random
+import tempfile
+import threading
 import unittest
-from task_allocation import Robot, TaskManager
+from unittest import mock
+
+import task_allocation
+from task_allocation import Robot, TaskManager, ZonedTaskManager
 from task_allocation import TaskTrolly, TaskCharge, TaskStandby
 from task_allocation import SubTaskDriving, SubTaskCharging
 from task_allocation import SubTaskAttaching, SubTaskDetaching
 from task_allocation import min_cost_task, match_robots_to_tasks
+from task_allocation import build_scenario
+from task_allocation import ResultsCollector, ResultsTable
+from task_allocation import OrderedTaskSet, SharedTaskSet
+from task_allocation import TaskBase, TaskDefinition, TaskPipeline
+from task_allocation import main, numpy
 
 
 class TestUtilityFunctions(unittest.TestCase):
@@ -43,6 +58,57 @@ class TestUtilityFunctions(unittest.TestCase):
                          set([(robotAt16, charge_task_at7),
                               (robotAt6, charge_task_at1)]))
 
+    def test_match_robots_to_tasks_some_infeasible(self):
+        flat = Robot(6)
+        flat.kwh_used = 99
+        robotAt16 = Robot(16)
+        task_at90 = TaskCharge(90)
+
+        # the flat robot cant reach any station, the other one can
+        self.assertEqual(match_robots_to_tasks([flat, robotAt16],
+                                               [task_at90]),
+                         [(robotAt16, task_at90)])
+
+    def test_match_robots_to_tasks_none_feasible(self):
+        flatAt6 = Robot(6)
+        flatAt16 = Robot(16)
+        flatAt6.kwh_used = 99
+        flatAt16.kwh_used = 99
+
+        self.assertEqual(match_robots_to_tasks([flatAt6, flatAt16],
+                                               [TaskCharge(90)]), [])
+
+    def test_match_robots_to_tasks_same_as_reference(self):
+        # the matcher before candidate rankings were reused
+        def reference(robots_, tasks):
+            robots = robots_.copy()
+            results = []
+            while (len(robots) > 0 and len(tasks) > 0):
+                task_costs = map(lambda r: (r, min_cost_task(r, tasks)),
+                                 robots)
+                robot, (task, _) = max(task_costs, key=lambda z: z[1][1])
+                if task is not None:
+                    results.append((robot, task))
+                    tasks.remove(task)
+                robots.remove(robot)
+            return results
+
+        rnd = random.Random(31)
+        for _ in range(200):
+            robots = [Robot(rnd.randrange(100))
+                      for _ in range(rnd.randrange(1, 8))]
+            for robot in robots:
+                robot.kwh_used = rnd.choice([0, 20, 49.5])
+            tasks = [TaskTrolly(*rnd.sample(range(100), 2))
+                     for _ in range(rnd.randrange(0, 12))]
+            tasks += [TaskCharge(rnd.randrange(100))
+                      for _ in range(rnd.randrange(0, 3))]
+
+            self.assertEqual(match_robots_to_tasks(robots, set(tasks)),
+                             reference(robots, set(tasks)))
+            self.assertEqual(match_robots_to_tasks(robots, list(tasks)),
+                             reference(robots, list(tasks)))
+
 
 class TestSubTaskCostCalculation(unittest.TestCase):
     def test_driving_cost(self):
@@ -79,6 +145,20 @@ class TestSubTaskCostCalculation(unittest.TestCase):
         self.assertEqual(robot.kwh_used, 0)
         self.assertEqual(charging.calc_cost(robot), (0, 0))
 
+    def test_partial_charging_cost(self):
+        robot = Robot(6)
+        charging = SubTaskCharging(10)
+
+        # only charge down to the target
+        robot.kwh_used = 30
+        self.assertEqual(charging.calc_cost(robot), (20, -20))
+        self.assertEqual(robot.kwh_used, 10)
+
+        # already above the target, nothing to do
+        robot.kwh_used = 5
+        self.assertEqual(charging.calc_cost(robot), (0, 0))
+        self.assertEqual(robot.kwh_used, 5)
+
     def test_attaching_detaching_cost(self):
         robot = Robot(6)
         attaching = SubTaskAttaching()
@@ -152,6 +232,22 @@ class TestTaskCommon(unittest.TestCase):
         self.assertEqual(costs, (dist_to_trolly,
                                  distance * 0.2 + grab))
 
+    def test_remaining_cost_calculation(self):
+        robot = Robot(6)
+        task = TaskTrolly(1, 3)
+
+        # nothing done yet, remaining is the whole task
+        self.assertEqual(task.calc_remaining_costs(robot)[0],
+                         (6 - 1) + 1 + (3 - 1) + 1)
+
+        # drive to the trolly and attach
+        for _ in range(6 - 1 + 1):
+            task.tick(robot)
+
+        time, power = task.calc_remaining_costs(robot)
+        self.assertEqual(time, (3 - 1) + 1)
+        self.assertAlmostEqual(power, (3 - 1) * 0.2 + 0.1)
+
     def test_task_charge_transitioning(self):
         task_charge = TaskCharge(10)
         r = Robot(6)
@@ -187,6 +283,124 @@ class TestTaskCommon(unittest.TestCase):
 
         self.assertEqual(task.tick(r), None)
 
+    def test_compiled_costs_same_as_subtasks(self):
+        rnd = random.Random(32)
+        for _ in range(500):
+            robot = Robot(rnd.randrange(100))
+            robot.kwh_used = rnd.uniform(0, 100)
+            task = rnd.choice([TaskTrolly(*rnd.sample(range(100), 2)),
+                               TaskCharge(rnd.randrange(100))])
+
+            compiled = task.calc_costs(robot)
+            task.cost_kernel = False  # cost each subtask instead
+            self.assertEqual(compiled, task.calc_costs(robot))
+
+    def test_compiled_costs_dont_mutate_robot(self):
+        robot = Robot(6)
+        robot.kwh_used = 10
+        TaskTrolly(1, 3).calc_costs(robot)
+        self.assertEqual((robot.location, robot.kwh_used), (6, 10))
+
+
+class TestTaskDefinition(unittest.TestCase):
+    def setUp(self):
+        self.trolly = TaskDefinition('trolly', [('drive', 'source'),
+                                                ('attach',),
+                                                ('drive', 'destination'),
+                                                ('detach',)])
+
+    def test_create(self):
+        task = self.trolly.create(source=1, destination=3)
+        self.assertIsInstance(task, TaskPipeline)
+        self.assertFalse(task.is_standby())
+        self.assertIsInstance(task.subtasks[0], SubTaskDriving)
+        self.assertIsInstance(task.subtasks[1], SubTaskAttaching)
+        self.assertIsInstance(task.subtasks[2], SubTaskDriving)
+        self.assertIsInstance(task.subtasks[3], SubTaskDetaching)
+        self.assertEqual(task.subtasks[0].destination, 1)
+        self.assertEqual(task.subtasks[2].destination, 3)
+
+    def test_same_costs_as_hand_written(self):
+        robot = Robot(6)
+        self.assertEqual(self.trolly.create(source=1, destination=3)
+                         .calc_costs(robot),
+                         TaskTrolly(1, 3).calc_costs(robot))
+
+    def test_bad_definitions(self):
+        with self.assertRaises(ValueError):
+            TaskDefinition('fly', [('fly', 'destination')])
+
+        with self.assertRaises(ValueError):
+            self.trolly.create(source=1)
+
+        with self.assertRaises(ValueError):
+            TaskDefinition('nothing', [])
+
+        # tasks have to start somewhere
+        with self.assertRaises(ValueError):
+            TaskDefinition('stay', [('attach',), ('drive', 'destination')])
+
+        for steps in [[('drive',)], [('drive', 'a', 'b')],
+                      [('drive', 'a'), ('attach', 'b')],
+                      [('drive', 'a'), ('charge', 'b', 'c')]]:
+            with self.assertRaises(ValueError):
+                TaskDefinition('bad', steps)
+
+        # charge takes an optional target
+        TaskDefinition('charge', [('drive', 'a'), ('charge',)])
+        TaskDefinition('charge', [('drive', 'a'), ('charge', 'target')])
+
+    def test_kernel_compiled_by_definition(self):
+        relay = TaskDefinition('relay', [('drive', 'a'), ('attach',),
+                                         ('drive', 'b'), ('charge', 't'),
+                                         ('drive', 'b'), ('detach',),
+                                         ('drive', 'c')])
+        rnd = random.Random(32)
+        for _ in range(100):
+            params = {name: rnd.randrange(20) for name in 'abct'}
+            task = relay.create(**params)
+            self.assertEqual(task.cost_kernel, task.compile_costs())
+
+    def test_step_table_ticks_like_subtasks(self):
+        relay = TaskDefinition('relay', [('drive', 'a'), ('attach',),
+                                         ('drive', 'b'), ('charge', 't'),
+                                         ('detach',), ('drive', 'a')])
+        rnd = random.Random(32)
+        for _ in range(20):
+            params = {name: rnd.randrange(20) for name in 'abt'}
+            table, subtasks = relay.create(**params), relay.create(**params)
+            robot = Robot(rnd.randrange(20))
+            robot.kwh_used = rnd.uniform(0, 50)
+            twin = Robot(robot.location)
+            twin.kwh_used = robot.kwh_used
+
+            for _ in range(200):
+                self.assertIs(type(table.tick(robot)),
+                              type(TaskBase.tick(subtasks, twin)))
+                self.assertEqual((robot.location, robot.kwh_used,
+                                  table.subtask_index),
+                                 (twin.location, twin.kwh_used,
+                                  subtasks.subtask_index))
+
+    def test_pipeline_ticks(self):
+        tm = TaskManager({})
+        robot = Robot(6)
+        tm.add_robot(robot)
+        relay = TaskDefinition('relay', [('drive', 'a'), ('attach',),
+                                         ('drive', 'b'), ('detach',),
+                                         ('drive', 'c')])
+        task = relay.create(a=7, b=9, c=4)
+        tm.add_task(task)
+
+        subtasks = [subtask for _ in range(10)
+                    for (_, subtask) in tm.tick()]
+        self.assertEqual(robot.current_task, task)
+        self.assertEqual([type(st) for st in subtasks],
+                         [SubTaskDriving, SubTaskAttaching,
+                          SubTaskDriving, SubTaskDriving,
+                          SubTaskDetaching] + [SubTaskDriving] * 5)
+        self.assertEqual(robot.location, 4)
+
 
 class TestTaskStandby(unittest.TestCase):
     def test_task_standby(self):
@@ -240,6 +454,24 @@ class TestRobot(unittest.TestCase):
         robot.kwh_used = -10
         self.assertEqual(robot.kwh_available(), 100)
 
+    def test_kwh_forecast(self):
+        robot = Robot(6)
+        robot.kwh_used = 45
+
+        # idle robots keep what they have
+        self.assertEqual(robot.kwh_forecast(), 55)
+        self.assertFalse(robot.needs_charge_soon())
+
+        # driving to 36 and back costs 12kwh
+        robot.assign_task(TaskTrolly(36, 6))
+        self.assertAlmostEqual(robot.kwh_forecast(), 55 - 12 - 0.4)
+        self.assertFalse(robot.needs_charge())
+        self.assertTrue(robot.needs_charge_soon())
+
+        # charging forecasts a full battery
+        robot.assign_task(TaskCharge(6))
+        self.assertEqual(robot.kwh_forecast(), 100)
+
     def test_is_idle(self):
         robot = Robot(6)
         # new robots are idle
@@ -317,6 +549,67 @@ class TestTaskManager(unittest.TestCase):
         self.assertEqual(task_manager.tasks, set([task_chargeAt7,
                                                   task_chargeAt17]))
 
+    def test_submit_task(self):
+        task_manager = TaskManager({})
+        task = TaskTrolly(1, 2)
+
+        # submitted tasks wait for the next tick
+        self.assertTrue(task_manager.submit_task(task))
+        self.assertEqual(task_manager.tasks, set())
+
+        task_manager.tick()
+        self.assertEqual(task_manager.tasks, set([task]))
+
+    def test_submit_task_many_threads(self):
+        task_manager = TaskManager({})
+        task_manager.add_robot(Robot(0))
+        tasks = [TaskTrolly(1, 2) for _ in range(2000)]
+
+        def produce(chunk):
+            for task in chunk:
+                task_manager.submit_task(task)
+
+        threads = [threading.Thread(target=produce, args=(tasks[i::8],))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            task_manager.tick()
+        for thread in threads:
+            thread.join()
+        task_manager.tick()
+
+        # every task made it, the robot took one of them
+        self.assertEqual(len(task_manager.tasks), len(tasks) - 1)
+        self.assertEqual(task_manager.tasks | {task_manager.robots[0]
+                                               .current_task},
+                         set(tasks))
+
+    def test_submit_task_bounded(self):
+        task_manager = TaskManager({})
+        task_manager.pending_slots = threading.Semaphore(1)
+
+        self.assertTrue(task_manager.submit_task(TaskTrolly(1, 2)))
+        # full, the producer gives up after the timeout
+        self.assertFalse(task_manager.submit_task(TaskTrolly(1, 2),
+                                                  timeout=0.01))
+
+        # draining frees the slot again
+        self.assertEqual(task_manager.ingest_tasks(), 1)
+        self.assertTrue(task_manager.submit_task(TaskTrolly(1, 2),
+                                                 timeout=0.01))
+
+    def test_fleet_state(self):
+        task_manager = TaskManager({})
+        robot = Robot(6)
+        task_manager.add_robot(robot)
+        self.assertEqual(task_manager.fleet_state, ())
+
+        task_manager.add_task(TaskTrolly(10, 20))
+        task_manager.tick()
+        self.assertEqual(task_manager.fleet_state,
+                         ((7, robot.kwh_available(), False),))
+
     def test_get_idle_robots(self):
         task_manager = TaskManager({5: None})
 
@@ -346,6 +639,208 @@ class TestTaskManager(unittest.TestCase):
                               taskB.subtasks[0].destination]),
                          set([5, 7]))
 
+    def test_free_charging_tasks_reused(self):
+        tm = TaskManager({5: None, 7: None})
+        first = tm.get_free_charge_tasks()
+        self.assertEqual(tm.get_free_charge_tasks(), first)
+
+        # a charge task is only handed out once
+        robot = Robot(6)
+        robot.kwh_used = 60
+        tm.add_robot(robot)
+        tm.tick()
+        self.assertIn(robot.current_task, first)
+        self.assertNotIn(robot.current_task, tm.get_free_charge_tasks())
+
+    def test_forecast_stations(self):
+        charging_stations = {1: None, 10: None}
+        tm = TaskManager(charging_stations)
+        robot = Robot(6)
+        robot.kwh_used = 60
+        tm.add_robot(robot)
+
+        self.assertEqual(tm.forecast_stations(), {1: 0, 10: 0})
+
+        tm.tick()
+        # robot is off to station 10, 3 more ticks to drive then charge
+        self.assertEqual(charging_stations[10], robot)
+        forecast = tm.forecast_stations()
+        self.assertEqual(forecast[1], 0)
+        self.assertAlmostEqual(forecast[10], 3 + 60 + 4 * 0.2)
+
+    def test_task_manager_top_up(self):
+        charging_stations = {1: None, 10: None}
+        tm = TaskManager(charging_stations, top_up=True)
+        robot = Robot(6)
+        robot.kwh_used = 30
+        tm.add_robot(robot)
+
+        # no work to do, so use the time to top up
+        tm.tick()
+        self.assertIsInstance(robot.current_task, TaskCharge)
+        self.assertEqual(charging_stations[10], robot)
+
+        # top ups are partial, the station is given back early
+        ticks = 1
+        while isinstance(robot.current_task, TaskCharge):
+            tm.tick()
+            ticks += 1
+        self.assertEqual(robot.kwh_used, 30 - 20)
+        self.assertEqual(charging_stations[10], None)
+        # 4 ticks driving, 21 charging and the tick it finishes on
+        self.assertEqual(ticks, 4 + 21 + 1)
+
+    def test_task_manager_top_up_holds_back_stations(self):
+        charging_stations = {1: None}
+        tm = TaskManager(charging_stations, top_up=True)
+        idle = Robot(6)
+        idle.kwh_used = 30
+        busy = Robot(50)
+        busy.kwh_used = 45
+        busy.assign_task(TaskTrolly(90, 50))
+        tm.add_robot(idle)
+        tm.add_robot(busy)
+
+        # the only station is kept for the robot that will soon be flat
+        tm.tick()
+        self.assertIsInstance(idle.current_task, TaskStandby)
+        self.assertEqual(charging_stations[1], None)
+        self.assertEqual(tm.reservations, {1: busy})
+
+    def test_task_manager_reserved_station_goes_to_its_robot(self):
+        charging_stations = {1: None, 40: None}
+        tm = TaskManager(charging_stations, top_up=True)
+        busy = Robot(50)
+        busy.kwh_used = 47
+        busy.assign_task(TaskTrolly(60, 50))  # flat in 21 ticks
+        tm.add_robot(busy)
+
+        tm.tick()
+        self.assertEqual(tm.reservations, {40: busy})
+
+        # a robot going flat nearer station 40 does not get it
+        flat = Robot(41)
+        flat.kwh_used = 60
+        tm.add_robot(flat)
+        tm.tick()
+        self.assertEqual(charging_stations[1], flat)
+        self.assertEqual(charging_stations[40], None)
+
+        while not isinstance(busy.current_task, TaskCharge):
+            tm.tick()
+        self.assertEqual(busy.current_task.get_station(), 40)
+        self.assertEqual(charging_stations[40], busy)
+        self.assertEqual(tm.reservations, {})
+
+    def test_task_manager_top_up_when_station_frees_in_time(self):
+        charging_stations = {1: None, 95: None}
+        tm = TaskManager(charging_stations, top_up=True)
+        idle = Robot(6)
+        idle.kwh_used = 30
+        busy = Robot(50)
+        busy.kwh_used = 45
+        busy.assign_task(TaskTrolly(90, 50))
+        charging = Robot(95)
+        charging.kwh_used = 3
+        charging.assign_task(TaskCharge(95))
+        charging_stations[95] = charging
+        tm.add_robot(idle)
+        tm.add_robot(busy)
+        tm.add_robot(charging)
+
+        # station 95 is free long before the busy robot is done, so the
+        # idle robot can have station 1
+        tm.tick()
+        self.assertIsInstance(idle.current_task, TaskCharge)
+        self.assertEqual(charging_stations[1], idle)
+
+    def test_uncovered_robots(self):
+        tm = TaskManager({1: None, 2: None})
+        soon = Robot(50)
+        soon.assign_task(TaskTrolly(60, 50))  # 21 ticks
+        late = Robot(50)
+        late.assign_task(TaskTrolly(90, 50))  # 81 ticks
+        charging = Robot(2)
+        charging.kwh_used = 40
+        charging.assign_task(TaskCharge(2))  # 40 ticks
+        tm.charging_stations[2] = charging
+
+        # only the robot finishing after station 2 is free is covered
+        self.assertEqual(tm.get_uncovered_robots([late, soon]), [soon])
+
+    def test_end_location(self):
+        robot = Robot(6)
+        task = TaskTrolly(60, 50)
+        self.assertEqual(task.end_location(robot), 50)
+        self.assertEqual(TaskStandby().end_location(robot), 6)
+
+    def test_task_manager_no_top_up_by_default(self):
+        charging_stations = {1: None}
+        tm = TaskManager(charging_stations)
+        robot = Robot(6)
+        robot.kwh_used = 30
+        tm.add_robot(robot)
+
+        tm.tick()
+        self.assertIsInstance(robot.current_task, TaskStandby)
+        self.assertEqual(charging_stations[1], None)
+
+    def test_tick_phases(self):
+        task_manager = TaskManager({})
+        robot = Robot(6)
+        task_manager.add_robot(robot)
+        task = TaskTrolly(10, 20)
+        task_manager.submit_task(task)
+
+        self.assertEqual(task_manager.ingest_tasks(), 1)
+        task_manager.allocate()
+        self.assertEqual(robot.current_task, task)
+        self.assertEqual(robot.location, 6)
+
+        [(robo, tick)] = task_manager.advance()
+        self.assertIsInstance(tick, SubTaskDriving)
+        self.assertEqual(robot.location, 7)
+
+    def test_is_finished(self):
+        task_manager = TaskManager({})
+        robot = Robot(6)
+        task_manager.add_robot(robot)
+        self.assertTrue(task_manager.is_finished())
+
+        task_manager.submit_task(TaskTrolly(7, 8))
+        self.assertFalse(task_manager.is_finished())
+
+        ticks = 0
+        while not task_manager.is_finished():
+            task_manager.tick()
+            ticks += 1
+        # drive, attach, drive, detach and the tick it finishes on
+        self.assertEqual(ticks, 5)
+
+    def test_build_scenario(self):
+        tm_a = build_scenario(3, qty_stations=2, qty_robots=4, qty_tasks=10)
+        tm_b = build_scenario(3, qty_stations=2, qty_robots=4, qty_tasks=10)
+
+        self.assertEqual(len(tm_a.charging_stations), 2)
+        self.assertEqual(len(tm_a.robots), 4)
+        self.assertEqual(len(tm_a.tasks), 10)
+
+        # same seed, same store
+        self.assertEqual(tm_a.charging_stations, tm_b.charging_stations)
+        self.assertEqual([r.location for r in tm_a.robots],
+                         [r.location for r in tm_b.robots])
+        self.assertEqual(sorted(str(t).split()[2:] for t in tm_a.tasks),
+                         sorted(str(t).split()[2:] for t in tm_b.tasks))
+
+    def test_build_scenario_reproducible(self):
+        def run():
+            tm = build_scenario(5, qty_robots=6, qty_tasks=60)
+            while not tm.is_finished():
+                tm.tick()
+            return tm.tick_count, [r.location for r in tm.robots]
+
+        self.assertEqual(run(), run())
+
     def test_task_manager_not_enough_power(self):
         charging_stations = {999: None}
         tm = TaskManager(charging_stations)
@@ -536,5 +1031,516 @@ class TestTaskManager(unittest.TestCase):
         self.assertEqual(robo2_subtask, None)
 
 
+class TestResults(unittest.TestCase):
+    def test_results_table_grows(self):
+        table = ResultsTable([('a', 'q'), ('b', 'd')], 2)
+        for i in range(5):
+            row = table.add_row()
+            table.columns['a'][row] = i
+
+        self.assertEqual(table.rows, 5)
+        self.assertEqual(list(table.column('a')), [0, 1, 2, 3, 4])
+        # never recorded
+        self.assertEqual(list(table.column('b')), [-1] * 5)
+
+    def test_collect_trolly_results(self):
+        tm = TaskManager({1: None})
+        results = ResultsCollector()
+        robot = Robot(6)
+        tm.add_robot(robot)
+        tm.collect_results(results)
+        tm.add_task(TaskTrolly(10, 20))
+
+        while not tm.is_finished():
+            tm.tick()
+
+        tasks = results.tasks
+        self.assertEqual(tasks.rows, 1)
+        self.assertEqual(tasks.column('added_tick')[0], 0)
+        self.assertEqual(tasks.column('assigned_tick')[0], 0)
+        self.assertEqual(tasks.column('wait_ticks')[0], 0)
+        # 4 driving, attach, 10 driving, detach
+        self.assertEqual(tasks.column('completed_tick')[0], 15)
+        self.assertEqual(tasks.column('distance')[0], 4 + 10)
+        self.assertAlmostEqual(tasks.column('kwh_used')[0],
+                               14 * 0.2 + 0.3 + 0.1)
+
+        robots = results.robots
+        self.assertEqual(robots.column('distance')[0], 14)
+        self.assertAlmostEqual(robots.column('kwh_used')[0], robot.kwh_used)
+        self.assertEqual(robots.column('busy_ticks')[0], 16)
+        self.assertEqual(robots.column('charge_wait_ticks')[0], 0)
+
+        self.assertEqual(list(results.stations.column('location')), [1])
+        self.assertEqual(list(results.stations.column('occupied_ticks')),
+                         [0])
+
+    def test_collect_charging_results(self):
+        tm = TaskManager({1: None})
+        results = ResultsCollector()
+        tm.collect_results(results)
+        robot = Robot(6)
+        robot.kwh_used = 60
+        tm.add_robot(robot)
+
+        while robot.is_idle():
+            tm.tick()
+        while not tm.is_finished():
+            tm.tick()
+
+        robots = results.robots
+        self.assertAlmostEqual(robots.column('kwh_charged')[0], 61)
+        # 5 driving, 61 charging
+        self.assertEqual(results.stations.column('occupied_ticks')[0],
+                         5 + 61)
+
+    def test_charge_wait_ticks(self):
+        tm = TaskManager({})
+        results = ResultsCollector()
+        tm.collect_results(results)
+        robot = Robot(6)
+        robot.kwh_used = 60
+        tm.add_robot(robot)
+
+        # no stations, so we wait
+        for _ in range(3):
+            tm.tick()
+        self.assertEqual(results.robots.column('charge_wait_ticks')[0], 3)
+
+    def test_write_csv(self):
+        tm = TaskManager({1: None})
+        results = ResultsCollector()
+        tm.collect_results(results)
+        tm.add_robot(Robot(6))
+        tm.add_task(TaskTrolly(7, 8))
+        tm.tick()
+
+        with tempfile.TemporaryDirectory() as directory:
+            prefix = os.path.join(directory, 'run')
+            results.write_csv(prefix)
+
+            with open(prefix + '_tasks.csv') as f:
+                rows = list(csv.reader(f))
+            self.assertEqual(rows[0], [n for n, _ in
+                                       ResultsCollector.task_columns])
+            self.assertEqual(rows[1][:4], ['0', '0', '-1', '0'])
+
+            for name in ['robots', 'stations']:
+                with open("%s_%s.csv" % (prefix, name)) as f:
+                    self.assertEqual(len(list(csv.reader(f))), 2)
+
+    def test_stations_added_later(self):
+        tm = TaskManager({1: None})
+        results = ResultsCollector()
+        tm.collect_results(results)
+        robot = Robot(30)
+        robot.kwh_used = 60
+        tm.add_robot(robot)
+
+        tm.charging_stations[31] = None
+        tm.tick()
+        tm.tick()
+        self.assertEqual(list(results.stations.column('location')), [1, 31])
+        self.assertEqual(list(results.stations.column('occupied_ticks')),
+                         [0, 2])
+
+    def collected(self):
+        tm = TaskManager({1: None})
+        results = ResultsCollector()
+        tm.collect_results(results)
+        tm.add_robot(Robot(6))
+        tm.add_task(TaskTrolly(7, 8))
+        while not tm.is_finished():
+            tm.tick()
+        return results
+
+    @unittest.skipUnless(numpy, "needs numpy")
+    def test_write_npz(self):
+        results = self.collected()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'run.npz')
+            results.write_npz(path)
+            with numpy.load(path) as arrays:
+                for name in ['tasks', 'robots', 'stations']:
+                    table = getattr(results, name)
+                    for column in table.names:
+                        self.assertEqual(
+                            arrays["%s_%s" % (name, column)].tolist(),
+                            table.column(column).tolist())
+
+    def test_write_npz_without_numpy(self):
+        results = self.collected()
+
+        with mock.patch.object(task_allocation, 'numpy', None):
+            with self.assertRaises(RuntimeError):
+                results.write_npz(os.path.join(tempfile.gettempdir(),
+                                               'never_written.npz'))
+
+
+class TestTaskManagerFork(unittest.TestCase):
+    def state(self, tm):
+        return ([(r.location, r.kwh_used, type(r.current_task),
+                  r.current_task.subtask_index) for r in tm.robots],
+                len(tm.tasks),
+                [station for station, robot in tm.charging_stations.items()
+                 if robot is None])
+
+    def test_fork_leaves_parent_alone(self):
+        tm = build_scenario(33, qty_robots=10, qty_tasks=100)
+        for _ in range(20):
+            tm.tick()
+        before = self.state(tm)
+        tasks = set(tm.tasks)
+
+        # what if a robot goes offline and we add a station
+        forked = tm.fork()
+        forked.robots.pop(0)
+        forked.charging_stations[50] = None
+        for _ in range(100):
+            forked.tick()
+
+        self.assertEqual(self.state(tm), before)
+        self.assertEqual(set(tm.tasks), tasks)
+        self.assertEqual(len(tm.robots), 10)
+        self.assertNotIn(50, tm.charging_stations)
+        self.assertTrue(all(task.subtask_index == 0 for task in tm.tasks))
+
+    def test_unchanged_fork_runs_like_parent(self):
+        tm = build_scenario(34, qty_robots=10, qty_tasks=100)
+        for _ in range(20):
+            tm.tick()
+
+        forks = [tm.fork() for _ in range(3)]
+        for _ in range(150):
+            tm.tick()
+            for forked in forks:
+                forked.tick()
+
+        for forked in forks:
+            self.assertEqual(self.state(forked), self.state(tm))
+            self.assertEqual(forked.tick_count, tm.tick_count)
+
+    def test_fork_of_fork(self):
+        tm = build_scenario(35, qty_robots=4, qty_tasks=20)
+        forked = tm.fork()
+        forked.tick()
+        forked_again = forked.fork()
+        for _ in range(50):
+            forked.tick()
+            forked_again.tick()
+
+        self.assertEqual(self.state(forked_again), self.state(forked))
+        self.assertEqual(tm.tick_count, 0)
+
+    def test_fork_charging_stations(self):
+        charging_stations = {1: None}
+        tm = TaskManager(charging_stations)
+        robot = Robot(6)
+        robot.kwh_used = 60
+        tm.add_robot(robot)
+        tm.tick()
+
+        forked = tm.fork()
+        [forked_robot] = forked.robots
+        self.assertIsNot(forked_robot, robot)
+        self.assertEqual(forked.charging_stations, {1: forked_robot})
+        self.assertEqual(charging_stations, {1: robot})
+
+    def test_fork_shares_tasks(self):
+        tm = build_scenario(36, qty_robots=4, qty_tasks=20)
+        tm.tick()
+        forked = tm.fork()
+        forked_again = tm.fork()
+
+        # neither fork copied the tasks, they only keep their changes
+        self.assertIs(forked.tasks.base, tm.tasks.base)
+        self.assertIs(forked_again.tasks.base, tm.tasks.base)
+        task = next(iter(tm.tasks))
+        forked.tasks.remove(task)
+        self.assertNotIn(task, forked.tasks)
+        self.assertIn(task, tm.tasks)
+        self.assertIn(task, forked_again.tasks)
+
+    def test_parent_and_fork_both_collect(self):
+        def run(fork):
+            tm = build_scenario(37, qty_robots=4, qty_tasks=30)
+            results = ResultsCollector()
+            tm.collect_results(results)
+            for _ in range(10):
+                tm.tick()
+
+            if fork:
+                forked = tm.fork()
+                forked.collect_results(ResultsCollector())
+                for _ in range(100):
+                    forked.tick()
+
+            while not tm.is_finished():
+                tm.tick()
+            return {name: table.column(name).tolist()
+                    for table in [results.tasks, results.robots]
+                    for name in table.names}
+
+        # the fork finishing tasks does not touch the parent's rows
+        self.assertEqual(run(True), run(False))
+
+
+class TestSharedTaskSet(unittest.TestCase):
+    def test_changes_stay_apart(self):
+        base = OrderedTaskSet.fromkeys('abcd')
+        tasks = SharedTaskSet(base)
+        tasks.remove('b')
+        tasks.add('e')
+        forked = tasks.fork()
+        forked.remove('e')
+        forked.add('f')
+
+        self.assertEqual(list(tasks), ['a', 'c', 'd', 'e'])
+        self.assertEqual(list(forked), ['a', 'c', 'd', 'f'])
+        self.assertEqual(len(forked), 4)
+        self.assertIn('a', forked)
+        self.assertNotIn('b', forked)
+        self.assertEqual(list(base), ['a', 'b', 'c', 'd'])
+
+        with self.assertRaises(KeyError):
+            forked.remove('b')
+
+    def test_readding_keeps_order(self):
+        tasks = SharedTaskSet(OrderedTaskSet.fromkeys('abcd'))
+        tasks.remove('b')
+        tasks.add('b')
+        self.assertEqual(list(tasks), ['a', 'b', 'c', 'd'])
+
+    def test_compacts_once_most_of_base_is_gone(self):
+        base = OrderedTaskSet.fromkeys('abcd')
+        tasks = SharedTaskSet(base)
+        tasks.add('e')
+        tasks.remove('a')
+        tasks.remove('b')
+        self.assertIs(tasks.base, base)
+
+        tasks.remove('c')
+        self.assertIsNot(tasks.base, base)
+        self.assertEqual(list(tasks.base), ['d', 'e'])
+        self.assertEqual(list(tasks), ['d', 'e'])
+        self.assertEqual(list(base), ['a', 'b', 'c', 'd'])
+
+
+class TestZonedTaskManager(unittest.TestCase):
+    def test_zone_placement(self):
+        tm = ZonedTaskManager({5: None, 25: None}, 20)
+        robotAt6 = Robot(6)
+        robotAt46 = Robot(46)
+        tm.add_robot(robotAt6)
+        tm.add_robot(robotAt46)
+        task = TaskTrolly(30, 2)
+        tm.add_task(task)
+
+        self.assertEqual(set(tm.zones), set([0, 1, 2]))
+        self.assertEqual(tm.zones[0].robots, [robotAt6])
+        self.assertEqual(tm.zones[2].robots, [robotAt46])
+        # tasks live where they start
+        self.assertEqual(tm.zones[1].tasks, set([task]))
+        self.assertEqual(tm.zones[1].charging_stations, {25: None})
+
+        self.assertEqual(tm.robots, [robotAt6, robotAt46])
+        self.assertEqual(tm.tasks, set([task]))
+        self.assertEqual(tm.charging_stations, {5: None, 25: None})
+
+    def test_rebalance_idle_robot(self):
+        tm = ZonedTaskManager({}, 20)
+        robotAt6 = Robot(6)
+        robotAt66 = Robot(66)
+        tm.add_robot(robotAt6)
+        tm.add_robot(robotAt66)
+        task = TaskTrolly(30, 2)
+        tm.add_task(task)
+
+        # zone 1 has work but no robots, the nearest spare robot goes
+        tm.tick()
+        self.assertEqual(tm.zones[1].robots, [robotAt6])
+        self.assertEqual(robotAt6.current_task, task)
+        self.assertIsInstance(robotAt66.current_task, TaskStandby)
+
+    def test_rebalance_flat_robot(self):
+        charging_stations = {45: None}
+        tm = ZonedTaskManager(charging_stations, 20)
+        robot = Robot(6)
+        robot.kwh_used = 60
+        tm.add_robot(robot)
+
+        # no stations in zone 0, so go to the zone that has one
+        tm.tick()
+        self.assertEqual(tm.zones[2].robots, [robot])
+        self.assertIsInstance(robot.current_task, TaskCharge)
+        self.assertEqual(tm.charging_stations, {45: robot})
+
+    def test_flat_robot_waits_where_it_was_sent(self):
+        charger = Robot(45)
+        charger.kwh_used = 40
+        charger.assign_task(TaskCharge(45))
+        tm = ZonedTaskManager({45: charger}, 20)
+        tm.add_robot(charger)
+        robot = Robot(6)
+        robot.kwh_used = 60
+        tm.add_robot(robot)
+
+        # the only station is busy, wait in its zone rather than go back
+        # and be sent again every tick
+        with mock.patch.object(tm, 'move_robot',
+                               wraps=tm.move_robot) as move_robot:
+            for _ in range(3):
+                tm.tick()
+                self.assertEqual(tm.zones[0].robots, [])
+                self.assertEqual(tm.zones[2].robots, [charger, robot])
+                self.assertIsInstance(robot.current_task, TaskStandby)
+        self.assertEqual(move_robot.call_count, 1)
+
+    def test_flat_robot_goes_to_a_free_station(self):
+        charger = Robot(5)
+        charger.kwh_used = 40
+        charger.assign_task(TaskCharge(5))
+        tm = ZonedTaskManager({5: charger, 45: None}, 20)
+        tm.add_robot(charger)
+        robot = Robot(6)
+        robot.kwh_used = 60
+        tm.add_robot(robot)
+
+        # station 5 is nearer but busy for another 40 ticks
+        tm.tick()
+        self.assertEqual(tm.zones[2].robots, [robot])
+        self.assertEqual(robot.current_task.get_station(), 45)
+
+    def test_idle_robot_returns_to_its_zone(self):
+        tm = ZonedTaskManager({}, 20)
+        robot = Robot(6)
+        tm.add_robot(robot)
+        tm.add_task(TaskTrolly(8, 50))
+
+        while tm.tasks or not robot.is_idle():
+            tm.tick()
+        self.assertEqual(tm.zones[0].robots, [robot])
+
+        # it delivered the trolly into zone 2, so it works from there now
+        tm.tick()
+        self.assertEqual(tm.zones[0].robots, [])
+        self.assertEqual(tm.zones[2].robots, [robot])
+
+    def test_submit_task_while_ticking(self):
+        tm = ZonedTaskManager({}, 1)
+        for location in range(50):
+            tm.add_robot(Robot(location))
+        tasks = [TaskTrolly(i % 50, (i + 1) % 50) for i in range(500)]
+
+        # zones get created as tasks arrive, that must only happen on the
+        # tick thread
+        def produce():
+            for task in tasks:
+                tm.submit_task(task)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        while producer.is_alive():
+            tm.tick()
+        producer.join()
+        tm.tick()
+
+        # every task is either waiting in a zone or has been started
+        started = set(robot.current_task for robot in tm.robots)
+        started |= set(task for task in tasks if task.subtask_index > 0)
+        self.assertEqual(len(tm.pending_tasks), 0)
+        self.assertEqual(tm.tasks | (started & set(tasks)), set(tasks))
+
+    def test_zoned_run_completes(self):
+        rnd = random.Random(1)
+        tm = ZonedTaskManager(
+            {k: None for k in rnd.sample(range(0, 99), 5)}, 25)
+        for location in rnd.sample(range(0, 99), 20):
+            tm.add_robot(Robot(location))
+        tasks = set()
+        for _ in range(100):
+            task = TaskTrolly(*rnd.sample(range(0, 99), 2))
+            tasks.add(task)
+            tm.add_task(task)
+
+        done = set()
+        for _ in range(2000):
+            for robot, _ in tm.tick():
+                if robot.current_task in tasks:
+                    done.add(robot.current_task)
+            if not tm.tasks and all(r.is_idle() for r in tm.robots):
+                break
+
+        self.assertEqual(done, tasks)
+        self.assertEqual(len(tm.robots), 20)
+
+
+class TestMain(unittest.TestCase):
+    def run_main(self, *argv):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(main(list(argv)), 0)
+        return out.getvalue().splitlines()
+
+    def test_headless(self):
+        lines = self.run_main('--seed', '1', '--robots', '3', '--tasks', '10',
+                              '--stations', '1', '--headless')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith(
+            "Completed 10 tasks with 3 robots in "))
+        self.assertTrue(lines[1].endswith("ticks/s"))
+
+    def interrupted_store(self, *args):
+        tm = TaskManager({})
+        robot = Robot(6)
+        robot.kwh_used = 99.9
+        # battery protection will interrupt this on the first tick
+        robot.assign_task(TaskTrolly(50, 60))
+        tm.add_robot(robot)
+        return tm
+
+    def test_headless_silences_messages(self):
+        with mock.patch.object(task_allocation, 'build_scenario',
+                               self.interrupted_store):
+            lines = self.run_main('--headless', '--max-ticks', '3')
+        self.assertEqual(len(lines), 2)
+
+    def test_messages_go_through_output(self):
+        with mock.patch.object(task_allocation, 'build_scenario',
+                               self.interrupted_store):
+            lines = self.run_main('--every', '0', '--max-ticks', '3')
+        self.assertEqual(lines[0], "interrupting current task")
+        self.assertEqual(len(lines), 3)
+
+    def test_sampled_output(self):
+        lines = self.run_main('--seed', '1', '--robots', '3', '--tasks', '10',
+                              '--stations', '1', '--every', '5',
+                              '--max-ticks', '20', '--buffer-lines', '2')
+        # stations, robots at the start and every 5 ticks, then summary
+        self.assertEqual(lines.count("==== Robots ===="), 1 + 20 // 5)
+        self.assertTrue(lines[-2].startswith("Stopped after 20 ticks"))
+
+    def test_negative_counts(self):
+        for option in ['--every', '--buffer-lines']:
+            with contextlib.redirect_stderr(io.StringIO()) as err:
+                with self.assertRaises(SystemExit):
+                    main([option, '-1'])
+            self.assertIn("-1 is negative", err.getvalue())
+
+    def test_results(self):
+        with tempfile.TemporaryDirectory() as directory:
+            prefix = os.path.join(directory, 'run')
+            self.run_main('--seed', '1', '--robots', '3', '--tasks', '10',
+                          '--headless', '--results', prefix)
+            with open(prefix + '_tasks.csv') as f:
+                rows = list(csv.DictReader(f))
+            for name in ['robots', 'stations']:
+                self.assertTrue(os.path.exists("%s_%s.csv" % (prefix, name)))
+
+        self.assertEqual(len(rows), 10)
+        self.assertTrue(all(int(row['completed_tick']) >= 0 for row in rows))
+
+
 if __name__ == '__main__':
     unittest.main()